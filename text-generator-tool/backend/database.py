@@ -1,15 +1,43 @@
 import aiosqlite
+import hashlib
 import json
+from collections import Counter
 from datetime import datetime
 from typing import List, Optional
 import uuid
 
 DATABASE_PATH = "text_generator.db"
 
+# スキーマの版数（テーブル定義や移行処理を変更したら上げる）
+SCHEMA_VERSION = 2
+
+
+# 履歴に記録する生成メタデータ
+HISTORY_METADATA_COLUMNS = (
+    ("model", "TEXT"),
+    ("latency_ms", "REAL"),
+    ("prompt_tokens", "INTEGER"),
+    ("output_tokens", "INTEGER"),
+    ("cache_hit", "INTEGER DEFAULT 0"),
+)
+
+
+async def get_schema_version(db) -> int:
+    """適用済みのスキーマ版数を取得（未作成なら0）"""
+    try:
+        cursor = await db.execute("SELECT MAX(version) FROM schema_version")
+    except aiosqlite.OperationalError:
+        return 0
+    row = await cursor.fetchone()
+    return row[0] or 0
+
 
 async def init_db():
-    """データベースの初期化"""
+    """データベースの初期化（スキーマが最新なら何もしない）"""
     async with aiosqlite.connect(DATABASE_PATH) as db:
+        if await get_schema_version(db) >= SCHEMA_VERSION:
+            return
+        
         # ツール定義テーブル
         await db.execute("""
             CREATE TABLE IF NOT EXISTS tools (
@@ -21,6 +49,7 @@ async def init_db():
                 system_prompt TEXT NOT NULL,
                 user_prompt_template TEXT NOT NULL,
                 output_format TEXT,
+                output_schema TEXT,
                 input_fields TEXT NOT NULL,
                 is_template INTEGER DEFAULT 0,
                 created_at TEXT NOT NULL,
@@ -28,6 +57,27 @@ async def init_db():
             )
         """)
         
+        # 生成結果本文テーブル（ハッシュで重複排除し、参照数で管理）
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS outputs (
+                hash TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                ref_count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        
+        # 既存DBへのカラム追加
+        cursor = await db.execute("PRAGMA table_info(tools)")
+        columns = [row[1] for row in await cursor.fetchall()]
+        if "output_schema" not in columns:
+            await db.execute("ALTER TABLE tools ADD COLUMN output_schema TEXT")
+        
+        # 旧形式（本文を直接保持）の履歴をoutputs参照へ移行
+        cursor = await db.execute("PRAGMA table_info(history)")
+        columns = [row[1] for row in await cursor.fetchall()]
+        if "output" in columns:
+            await migrate_history_outputs(db)
+        
         # 生成履歴テーブル
         await db.execute("""
             CREATE TABLE IF NOT EXISTS history (
@@ -35,16 +85,92 @@ async def init_db():
                 tool_id TEXT NOT NULL,
                 tool_name TEXT NOT NULL,
                 inputs TEXT NOT NULL,
-                output TEXT NOT NULL,
+                output_hash TEXT NOT NULL,
+                model TEXT,
+                latency_ms REAL,
+                prompt_tokens INTEGER,
+                output_tokens INTEGER,
+                cache_hit INTEGER DEFAULT 0,
                 created_at TEXT NOT NULL,
-                FOREIGN KEY (tool_id) REFERENCES tools (id)
+                FOREIGN KEY (tool_id) REFERENCES tools (id),
+                FOREIGN KEY (output_hash) REFERENCES outputs (hash)
             )
         """)
         
+        # 生成メタデータのカラム追加（既存DB）
+        cursor = await db.execute("PRAGMA table_info(history)")
+        columns = [row[1] for row in await cursor.fetchall()]
+        for column, column_type in HISTORY_METADATA_COLUMNS:
+            if column not in columns:
+                await db.execute(f"ALTER TABLE history ADD COLUMN {column} {column_type}")
+        
+        # ツール別・時間別の利用集計テーブル（生成のたびに加算）
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS usage_hourly (
+                tool_id TEXT NOT NULL,
+                hour TEXT NOT NULL,
+                tool_name TEXT NOT NULL,
+                runs INTEGER NOT NULL DEFAULT 0,
+                errors INTEGER NOT NULL DEFAULT 0,
+                cache_hits INTEGER NOT NULL DEFAULT 0,
+                total_latency_ms REAL NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                output_tokens INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (tool_id, hour)
+            )
+        """)
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_usage_hourly_hour ON usage_hourly (hour)"
+        )
+        
         await db.commit()
         
         # 初期テンプレートの挿入
         await insert_default_templates(db)
+        
+        # 適用済みの版数を記録
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL, applied_at TEXT NOT NULL)"
+        )
+        await db.execute(
+            "INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+            (SCHEMA_VERSION, datetime.now().isoformat())
+        )
+        await db.commit()
+
+
+def output_hash(output: str) -> str:
+    """生成結果本文のハッシュ（outputsテーブルのキー）"""
+    return hashlib.sha256(output.encode("utf-8")).hexdigest()
+
+
+async def migrate_history_outputs(db):
+    """history.outputの本文をoutputsテーブルへ移し、ハッシュ参照に置き換える"""
+    await db.create_function("output_hash", 1, output_hash, deterministic=True)
+    
+    await db.execute("""
+        INSERT INTO outputs (hash, content, ref_count)
+        SELECT output_hash(output), output, COUNT(*) FROM history GROUP BY output
+        ON CONFLICT(hash) DO UPDATE SET ref_count = ref_count + excluded.ref_count
+    """)
+    await db.execute("""
+        CREATE TABLE history_new (
+            id TEXT PRIMARY KEY,
+            tool_id TEXT NOT NULL,
+            tool_name TEXT NOT NULL,
+            inputs TEXT NOT NULL,
+            output_hash TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (tool_id) REFERENCES tools (id),
+            FOREIGN KEY (output_hash) REFERENCES outputs (hash)
+        )
+    """)
+    await db.execute("""
+        INSERT INTO history_new (id, tool_id, tool_name, inputs, output_hash, created_at)
+        SELECT id, tool_id, tool_name, inputs, output_hash(output), created_at FROM history
+    """)
+    await db.execute("DROP TABLE history")
+    await db.execute("ALTER TABLE history_new RENAME TO history")
 
 
 async def insert_default_templates(db):
@@ -245,15 +371,56 @@ async def insert_default_templates(db):
     await db.commit()
 
 
-async def get_all_tools() -> List[dict]:
-    """全ツールを取得"""
+# 一覧表示用の軽量カラム（プロンプト類を含まない）
+TOOL_SUMMARY_COLUMNS = (
+    "id", "name", "description", "category", "llm_model",
+    "is_template", "created_at", "updated_at"
+)
+
+
+def escape_like(value: str) -> str:
+    """LIKE検索用に % と _ をエスケープ（ESCAPE '\\' と併用）"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+async def get_all_tools(
+    category: Optional[str] = None,
+    search: Optional[str] = None,
+    summary: bool = False
+) -> List[dict]:
+    """全ツールを取得（カテゴリ・名前で絞り込み、summary時は一覧用カラムのみ）"""
+    columns = ", ".join(TOOL_SUMMARY_COLUMNS) if summary else "*"
+    conditions = []
+    params = []
+    
+    if category:
+        conditions.append("category = ?")
+        params.append(category)
+    if search:
+        pattern = f"%{escape_like(search)}%"
+        conditions.append("(name LIKE ? ESCAPE '\\' OR description LIKE ? ESCAPE '\\')")
+        params.extend([pattern, pattern])
+    
+    query = f"SELECT {columns} FROM tools"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY created_at DESC"
+    
     async with aiosqlite.connect(DATABASE_PATH) as db:
         db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM tools ORDER BY created_at DESC")
+        cursor = await db.execute(query, params)
         rows = await cursor.fetchall()
         return [dict(row) for row in rows]
 
 
+async def get_tools_version() -> tuple:
+    """ツール一覧のバージョン（件数と最終更新日時）を取得"""
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        cursor = await db.execute("SELECT COUNT(*), MAX(updated_at) FROM tools")
+        count, last_updated = await cursor.fetchone()
+        return count, last_updated
+
+
 async def get_tool_by_id(tool_id: str) -> Optional[dict]:
     """IDでツールを取得"""
     async with aiosqlite.connect(DATABASE_PATH) as db:
@@ -263,6 +430,11 @@ async def get_tool_by_id(tool_id: str) -> Optional[dict]:
         return dict(row) if row else None
 
 
+def _dump_schema(schema: Optional[dict]) -> Optional[str]:
+    """出力スキーマをJSON文字列に変換（未指定はNULL）"""
+    return json.dumps(schema, ensure_ascii=False) if schema else None
+
+
 async def create_tool(tool_data: dict) -> str:
     """ツールを作成"""
     tool_id = str(uuid.uuid4())
@@ -271,14 +443,14 @@ async def create_tool(tool_data: dict) -> str:
     async with aiosqlite.connect(DATABASE_PATH) as db:
         await db.execute("""
             INSERT INTO tools (id, name, description, category, llm_model, system_prompt,
-                             user_prompt_template, output_format, input_fields, is_template,
-                             created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                             user_prompt_template, output_format, output_schema, input_fields,
+                             is_template, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, (
             tool_id, tool_data["name"], tool_data["description"], tool_data["category"],
             tool_data["llm_model"], tool_data["system_prompt"], tool_data["user_prompt_template"],
-            tool_data.get("output_format"), json.dumps(tool_data["input_fields"]), 0,
-            now, now
+            tool_data.get("output_format"), _dump_schema(tool_data.get("output_schema")),
+            json.dumps(tool_data["input_fields"]), 0, now, now
         ))
         await db.commit()
     
@@ -293,13 +465,13 @@ async def update_tool(tool_id: str, tool_data: dict) -> bool:
         await db.execute("""
             UPDATE tools SET name = ?, description = ?, category = ?, llm_model = ?,
                            system_prompt = ?, user_prompt_template = ?, output_format = ?,
-                           input_fields = ?, updated_at = ?
+                           output_schema = ?, input_fields = ?, updated_at = ?
             WHERE id = ?
         """, (
             tool_data["name"], tool_data["description"], tool_data["category"],
             tool_data["llm_model"], tool_data["system_prompt"], tool_data["user_prompt_template"],
-            tool_data.get("output_format"), json.dumps(tool_data["input_fields"]),
-            now, tool_id
+            tool_data.get("output_format"), _dump_schema(tool_data.get("output_schema")),
+            json.dumps(tool_data["input_fields"]), now, tool_id
         ))
         await db.commit()
     
@@ -315,45 +487,176 @@ async def delete_tool(tool_id: str) -> bool:
     return True
 
 
-async def save_history(tool_id: str, tool_name: str, inputs: dict, output: str) -> str:
-    """履歴を保存"""
+async def save_history(
+    tool_id: str,
+    tool_name: str,
+    inputs: dict,
+    output: str,
+    metadata: Optional[dict] = None
+) -> str:
+    """履歴を保存（本文は同一内容を共有し、利用集計も更新）"""
     history_id = str(uuid.uuid4())
-    now = datetime.now().isoformat()
+    now = datetime.now()
+    content_hash = output_hash(output)
+    metadata = metadata or {}
     
     async with aiosqlite.connect(DATABASE_PATH) as db:
         await db.execute("""
-            INSERT INTO history (id, tool_id, tool_name, inputs, output, created_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (history_id, tool_id, tool_name, json.dumps(inputs), output, now))
+            INSERT INTO outputs (hash, content, ref_count) VALUES (?, ?, 1)
+            ON CONFLICT(hash) DO UPDATE SET ref_count = ref_count + 1
+        """, (content_hash, output))
+        await db.execute("""
+            INSERT INTO history (id, tool_id, tool_name, inputs, output_hash, model,
+                               latency_ms, prompt_tokens, output_tokens, cache_hit, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            history_id, tool_id, tool_name, json.dumps(inputs), content_hash,
+            metadata.get("model"), metadata.get("latency_ms"),
+            metadata.get("prompt_tokens"), metadata.get("output_tokens"),
+            int(metadata.get("cache_hit", False)), now.isoformat()
+        ))
+        await update_usage_rollup(db, tool_id, tool_name, now, metadata, error=False)
         await db.commit()
     
     return history_id
 
 
+async def record_generation_error(tool_id: str, tool_name: str, metadata: Optional[dict] = None):
+    """生成失敗を利用集計に記録"""
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        await update_usage_rollup(db, tool_id, tool_name, datetime.now(), metadata or {}, error=True)
+        await db.commit()
+
+
+async def update_usage_rollup(
+    db,
+    tool_id: str,
+    tool_name: str,
+    timestamp: datetime,
+    metadata: dict,
+    error: bool
+):
+    """1回の生成結果を時間別集計に加算（レイテンシは成功した実行のみ合計）"""
+    hour = timestamp.strftime("%Y-%m-%dT%H:00")
+    latency_ms = 0 if error else metadata.get("latency_ms") or 0
+    await db.execute("""
+        INSERT INTO usage_hourly (tool_id, hour, tool_name, runs, errors, cache_hits,
+                                  total_latency_ms, prompt_tokens, output_tokens)
+        VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?)
+        ON CONFLICT(tool_id, hour) DO UPDATE SET
+            tool_name = excluded.tool_name,
+            runs = runs + 1,
+            errors = errors + excluded.errors,
+            cache_hits = cache_hits + excluded.cache_hits,
+            total_latency_ms = total_latency_ms + excluded.total_latency_ms,
+            prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+            output_tokens = output_tokens + excluded.output_tokens
+    """, (
+        tool_id, hour, tool_name, int(error), int(metadata.get("cache_hit", False)),
+        latency_ms, metadata.get("prompt_tokens") or 0,
+        metadata.get("output_tokens") or 0
+    ))
+
+
+async def get_usage_analytics(since_hour: str, tool_id: Optional[str] = None) -> dict:
+    """時間別集計からツール別の利用状況を取得（履歴の件数に依存しない）"""
+    where = "WHERE hour >= ?"
+    params = [since_hour]
+    if tool_id:
+        where += " AND tool_id = ?"
+        params.append(tool_id)
+    
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        db.row_factory = aiosqlite.Row
+        cursor = await db.execute(f"""
+            SELECT tool_id, MAX(tool_name) AS tool_name, SUM(runs) AS runs,
+                   SUM(errors) AS errors, SUM(cache_hits) AS cache_hits,
+                   SUM(total_latency_ms) AS total_latency_ms,
+                   SUM(prompt_tokens) AS prompt_tokens, SUM(output_tokens) AS output_tokens
+            FROM usage_hourly {where}
+            GROUP BY tool_id ORDER BY runs DESC
+        """, params)
+        tools = [dict(row) for row in await cursor.fetchall()]
+        
+        hourly = []
+        if tool_id:
+            cursor = await db.execute(f"""
+                SELECT hour, runs, errors, cache_hits, total_latency_ms,
+                       prompt_tokens, output_tokens
+                FROM usage_hourly {where} ORDER BY hour
+            """, params)
+            hourly = [dict(row) for row in await cursor.fetchall()]
+    
+    for row in tools + hourly:
+        successes = row["runs"] - row["errors"]
+        total_latency_ms = row.pop("total_latency_ms")
+        row["error_rate"] = row["errors"] / row["runs"] if row["runs"] else 0
+        row["avg_latency_ms"] = total_latency_ms / successes if successes else 0
+    
+    return {"tools": tools, "hourly": hourly}
+
+
 async def get_history(limit: int = 50, search: Optional[str] = None) -> List[dict]:
     """履歴を取得"""
+    query = """
+        SELECT h.id, h.tool_id, h.tool_name, h.inputs, o.content AS output, h.created_at
+        FROM history h JOIN outputs o ON o.hash = h.output_hash
+    """
+    
     async with aiosqlite.connect(DATABASE_PATH) as db:
         db.row_factory = aiosqlite.Row
         
         if search:
-            cursor = await db.execute("""
-                SELECT * FROM history 
-                WHERE tool_name LIKE ? OR output LIKE ?
-                ORDER BY created_at DESC LIMIT ?
+            cursor = await db.execute(query + """
+                WHERE h.tool_name LIKE ? OR o.content LIKE ?
+                ORDER BY h.created_at DESC LIMIT ?
             """, (f"%{search}%", f"%{search}%", limit))
         else:
             cursor = await db.execute(
-                "SELECT * FROM history ORDER BY created_at DESC LIMIT ?", (limit,)
+                query + " ORDER BY h.created_at DESC LIMIT ?", (limit,)
             )
         
         rows = await cursor.fetchall()
         return [dict(row) for row in rows]
 
 
+async def release_outputs(db, hashes: List[str]):
+    """削除した履歴が参照していた本文の参照数を減らし、参照されなくなった本文を削除"""
+    await db.executemany(
+        "UPDATE outputs SET ref_count = ref_count - ? WHERE hash = ?",
+        [(count, content_hash) for content_hash, count in Counter(hashes).items()]
+    )
+    # 減らした本文だけを対象に削除（全件走査を避ける）
+    await db.executemany(
+        "DELETE FROM outputs WHERE hash = ? AND ref_count <= 0",
+        [(content_hash,) for content_hash in set(hashes)]
+    )
+
+
 async def delete_history(history_id: str) -> bool:
     """履歴を削除"""
     async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("DELETE FROM history WHERE id = ?", (history_id,))
+        # 実際に削除した行の分だけ参照数を減らす（同時削除での二重減算を防ぐ）
+        cursor = await db.execute(
+            "DELETE FROM history WHERE id = ? RETURNING output_hash", (history_id,)
+        )
+        hashes = [row[0] for row in await cursor.fetchall()]
+        await release_outputs(db, hashes)
         await db.commit()
     
     return True
+
+
+async def delete_history_before(cutoff: datetime) -> int:
+    """指定日時より古い履歴を削除（保持期間の適用）し、削除件数を返す"""
+    cutoff = cutoff.isoformat()
+    
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        cursor = await db.execute(
+            "DELETE FROM history WHERE created_at < ? RETURNING output_hash", (cutoff,)
+        )
+        hashes = [row[0] for row in await cursor.fetchall()]
+        await release_outputs(db, hashes)
+        await db.commit()
+    
+    return len(hashes)
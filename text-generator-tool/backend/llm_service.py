@@ -1,19 +1,51 @@
-import google.generativeai as genai
 from typing import Optional
 import asyncio
+import json
+
+from structured_output import StructuredOutputCollector, StructuredOutputError
+
+# 構造化出力で失敗した項目を再生成する最大回数
+MAX_STRUCTURED_RETRIES = 2
+
+
+def import_genai():
+    """google.generativeaiを読み込む（起動時には読み込まない）"""
+    import google.generativeai as genai
+    return genai
+
+
+def add_usage(usage: Optional[dict], response):
+    """レスポンスのトークン使用量をusageに加算"""
+    metadata = getattr(response, "usage_metadata", None)
+    if usage is None or metadata is None:
+        return
+    usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + (metadata.prompt_token_count or 0)
+    usage["output_tokens"] = usage.get("output_tokens", 0) + (metadata.candidates_token_count or 0)
 
 
 class LLMService:
     def __init__(self):
         self.api_key = None
         self.initialized = False
+        self._genai = None
+        self._configured_key = None
     
     def initialize(self, api_key: str):
-        """Gemini APIを初期化"""
+        """Gemini APIを初期化（SDKの読み込みは初回生成時まで遅延）"""
         self.api_key = api_key
-        genai.configure(api_key=api_key)
         self.initialized = True
     
+    async def load_sdk(self):
+        """google.generativeaiをイベントループ外で読み込み、APIキーを設定"""
+        if self._genai is None:
+            # grpc/protobufを含み読み込みが重いため、スレッドで実行する
+            loop = asyncio.get_event_loop()
+            self._genai = await loop.run_in_executor(None, import_genai)
+        if self._configured_key != self.api_key:
+            self._genai.configure(api_key=self.api_key)
+            self._configured_key = self.api_key
+        return self._genai
+    
     def build_user_prompt(self, template: str, inputs: dict) -> str:
         """ユーザープロンプトを構築"""
         result = template
@@ -26,23 +58,29 @@ class LLMService:
             result = result.replace(placeholder, str(value) if value else "")
         return result
     
+    def _ensure_initialized(self):
+        if not self.initialized:
+            raise ValueError("LLMサービスが初期化されていません。APIキーを設定してください。")
+    
     async def generate(
         self,
         system_prompt: str,
         user_prompt_template: str,
         inputs: dict,
         model: str = "gemini-2.0-flash",
-        output_format: Optional[str] = None
+        output_format: Optional[str] = None,
+        usage: Optional[dict] = None
     ) -> str:
-        """テキストを生成"""
-        if not self.initialized:
-            raise ValueError("LLMサービスが初期化されていません。APIキーを設定してください。")
+        """テキストを生成（usageを渡すとトークン使用量を加算）"""
+        self._ensure_initialized()
         
         user_prompt = self.build_user_prompt(user_prompt_template, inputs)
         
         if output_format:
             user_prompt += f"\n\n【出力形式】\n{output_format}"
         
+        genai = await self.load_sdk()
+        
         # Geminiモデルの設定
         generation_config = genai.GenerationConfig(
             temperature=0.7,
@@ -63,7 +101,93 @@ class LLMService:
             lambda: gemini_model.generate_content(user_prompt)
         )
         
+        add_usage(usage, response)
         return response.text
+    
+    async def generate_structured(
+        self,
+        system_prompt: str,
+        user_prompt_template: str,
+        inputs: dict,
+        output_schema: dict,
+        model: str = "gemini-2.0-flash",
+        output_format: Optional[str] = None,
+        usage: Optional[dict] = None,
+        warnings: Optional[list] = None
+    ) -> dict:
+        """JSONスキーマに従った構造化出力を生成（失敗した項目のみ再生成）
+
+        再生成しても不正な任意項目は除外し、そのエラーをwarningsに追加する。
+        """
+        self._ensure_initialized()
+        
+        user_prompt = self.build_user_prompt(user_prompt_template, inputs)
+        
+        if output_format:
+            user_prompt += f"\n\n【出力形式】\n{output_format}"
+        
+        collector = StructuredOutputCollector(output_schema)
+        await self._stream_structured(
+            system_prompt, user_prompt, output_schema, model, collector, usage
+        )
+        
+        for _ in range(MAX_STRUCTURED_RETRIES):
+            failing = collector.failing_keys()
+            if not failing:
+                break
+            
+            # 確定済みの項目を文脈として渡し、失敗した項目だけを再生成
+            retry_prompt = (
+                f"{user_prompt}\n\n【生成済みの項目】\n"
+                f"{json.dumps(collector.values, ensure_ascii=False)}\n\n"
+                f"【再生成する項目】\n{', '.join(failing)}"
+            )
+            await self._stream_structured(
+                system_prompt, retry_prompt, collector.sub_schema(failing), model, collector, usage
+            )
+        
+        dropped = collector.drop_optional_errors()
+        if warnings is not None:
+            warnings.extend(dropped)
+        
+        if collector.failing_keys():
+            raise StructuredOutputError(
+                "出力がスキーマに適合しませんでした", collector.error_messages()
+            )
+        
+        return collector.values
+    
+    async def _stream_structured(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        schema: dict,
+        model: str,
+        collector: StructuredOutputCollector,
+        usage: Optional[dict] = None
+    ):
+        """構造化出力モードでストリーミング生成し、逐次パース・検証する"""
+        genai = await self.load_sdk()
+        generation_config = genai.GenerationConfig(
+            temperature=0.7,
+            max_output_tokens=4000,
+            response_mime_type="application/json",
+            response_schema=schema,
+        )
+        
+        gemini_model = genai.GenerativeModel(
+            model_name=model,
+            generation_config=generation_config,
+            system_instruction=system_prompt
+        )
+        
+        def run():
+            response = gemini_model.generate_content(user_prompt, stream=True)
+            collector.feed_stream(chunk.text for chunk in response)
+            add_usage(usage, response)
+        
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, run)
 
 
 # シングルトンインスタンス
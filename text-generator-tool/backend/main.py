@@ -1,19 +1,34 @@
-from fastapi import FastAPI, HTTPException
+import time
+
+# 起動時間計測の基準（各モジュールの読み込みより前に記録）
+PROCESS_START = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List
+from datetime import datetime, timedelta
+import asyncio
+import hashlib
 import json
+import logging
 import os
 from dotenv import load_dotenv
 
 from database import (
-    init_db, get_all_tools, get_tool_by_id, create_tool, 
-    update_tool, delete_tool, save_history, get_history, delete_history
+    init_db, get_all_tools, get_tools_version, get_tool_by_id, create_tool, 
+    update_tool, delete_tool, save_history, get_history, delete_history,
+    delete_history_before, record_generation_error, get_usage_analytics
 )
 from llm_service import llm_service
+from structured_output import StructuredOutputError, check_schema
+
+IMPORTS_DONE = time.perf_counter()
 
 load_dotenv()
 
+logger = logging.getLogger("uvicorn.error")
+
 app = FastAPI(title="テキスト生成ツール API")
 
 # CORS設定
@@ -23,6 +38,7 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 
@@ -35,6 +51,7 @@ class ToolCreate(BaseModel):
     system_prompt: str
     user_prompt_template: str
     output_format: Optional[str] = None
+    output_schema: Optional[dict] = None
     input_fields: List[dict]
 
 
@@ -50,11 +67,16 @@ class ApiKeyRequest(BaseModel):
 # グローバル変数でAPIキー状態を管理
 api_key_configured = False
 
+# コールドスタートの所要時間（ミリ秒）
+startup_timings = {}
+
 
 @app.on_event("startup")
 async def startup():
     """アプリケーション起動時の処理"""
+    init_started = time.perf_counter()
     await init_db()
+    init_finished = time.perf_counter()
     
     # 環境変数からAPIキーを読み込み
     api_key = os.getenv("GEMINI_API_KEY")
@@ -62,6 +84,30 @@ async def startup():
         llm_service.initialize(api_key)
         global api_key_configured
         api_key_configured = True
+    
+    startup_timings.update({
+        "imports_ms": round((IMPORTS_DONE - PROCESS_START) * 1000, 1),
+        "init_db_ms": round((init_finished - init_started) * 1000, 1),
+        "total_ms": round((time.perf_counter() - PROCESS_START) * 1000, 1),
+    })
+    logger.info(
+        "Cold start: imports %.1fms, init_db %.1fms, total %.1fms",
+        startup_timings["imports_ms"], startup_timings["init_db_ms"], startup_timings["total_ms"]
+    )
+    
+    # SDKは起動完了後にバックグラウンドで読み込み、初回リクエストの待ち時間を減らす
+    app.state.sdk_warmup = asyncio.create_task(warm_up_sdk())
+
+
+async def warm_up_sdk():
+    """Gemini SDKを事前に読み込む（失敗しても初回生成時に再試行される）"""
+    started = time.perf_counter()
+    try:
+        await llm_service.load_sdk()
+    except Exception as e:
+        logger.warning("Gemini SDK warm-up failed: %s", e)
+        return
+    startup_timings["sdk_warmup_ms"] = round((time.perf_counter() - started) * 1000, 1)
 
 
 @app.get("/")
@@ -74,7 +120,8 @@ async def get_status():
     """API状態を取得"""
     return {
         "api_key_configured": api_key_configured,
-        "message": "APIキーが設定されています" if api_key_configured else "APIキーを設定してください"
+        "message": "APIキーが設定されています" if api_key_configured else "APIキーを設定してください",
+        "startup_timings": startup_timings
     }
 
 
@@ -90,15 +137,53 @@ async def set_api_key(request: ApiKeyRequest):
         raise HTTPException(status_code=400, detail=str(e))
 
 
+def parse_tool_fields(tool: dict) -> dict:
+    """JSON文字列で保存されたカラムをパース"""
+    for key in ("input_fields", "output_schema"):
+        if isinstance(tool.get(key), str):
+            tool[key] = json.loads(tool[key])
+    return tool
+
+
+def validate_output_schema(tool: ToolCreate):
+    """出力スキーマの形式を確認"""
+    if tool.output_schema:
+        try:
+            check_schema(tool.output_schema)
+        except StructuredOutputError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+
 # ツール関連API
 @app.get("/api/tools")
-async def list_tools():
-    """全ツールを取得"""
-    tools = await get_all_tools()
-    # input_fieldsをパース
+async def list_tools(
+    request: Request,
+    response: Response,
+    category: Optional[str] = None,
+    search: Optional[str] = None,
+    view: str = "full"
+):
+    """全ツールを取得（view=summaryでプロンプトを除いた一覧用データ）"""
+    # 件数と最終更新日時からETagを算出（削除は件数の変化で検知）
+    count, last_updated = await get_tools_version()
+    version = f"{count}:{last_updated}:{view}:{category or ''}:{search or ''}"
+    etag = f'W/"{hashlib.md5(version.encode()).hexdigest()}"'
+    
+    if_none_match = [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+    if etag in if_none_match or "*" in if_none_match:
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    tools = await get_all_tools(
+        category=category,
+        search=search,
+        summary=(view == "summary")
+    )
+    # JSONカラムをパース
     for tool in tools:
-        if isinstance(tool["input_fields"], str):
-            tool["input_fields"] = json.loads(tool["input_fields"])
+        parse_tool_fields(tool)
+    
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
     return {"tools": tools}
 
 
@@ -109,15 +194,13 @@ async def get_tool(tool_id: str):
     if not tool:
         raise HTTPException(status_code=404, detail="ツールが見つかりません")
     
-    if isinstance(tool["input_fields"], str):
-        tool["input_fields"] = json.loads(tool["input_fields"])
-    
-    return {"tool": tool}
+    return {"tool": parse_tool_fields(tool)}
 
 
 @app.post("/api/tools")
 async def create_new_tool(tool: ToolCreate):
     """ツールを作成"""
+    validate_output_schema(tool)
     tool_data = tool.model_dump()
     tool_id = await create_tool(tool_data)
     return {"success": True, "tool_id": tool_id}
@@ -130,6 +213,7 @@ async def update_existing_tool(tool_id: str, tool: ToolCreate):
     if not existing:
         raise HTTPException(status_code=404, detail="ツールが見つかりません")
     
+    validate_output_schema(tool)
     tool_data = tool.model_dump()
     await update_tool(tool_id, tool_data)
     return {"success": True}
@@ -153,10 +237,7 @@ async def duplicate_tool(tool_id: str):
     if not tool:
         raise HTTPException(status_code=404, detail="ツールが見つかりません")
     
-    # input_fieldsをパース
-    input_fields = tool["input_fields"]
-    if isinstance(input_fields, str):
-        input_fields = json.loads(input_fields)
+    parse_tool_fields(tool)
     
     new_tool_data = {
         "name": f"{tool['name']} (コピー)",
@@ -166,7 +247,8 @@ async def duplicate_tool(tool_id: str):
         "system_prompt": tool["system_prompt"],
         "user_prompt_template": tool["user_prompt_template"],
         "output_format": tool["output_format"],
-        "input_fields": input_fields
+        "output_schema": tool.get("output_schema"),
+        "input_fields": tool["input_fields"]
     }
     
     new_tool_id = await create_tool(new_tool_data)
@@ -184,31 +266,88 @@ async def generate_text(request: GenerateRequest):
     if not tool:
         raise HTTPException(status_code=404, detail="ツールが見つかりません")
     
+    parse_tool_fields(tool)
+    structured = None
+    warnings = []
+    metadata = {"model": tool["llm_model"], "cache_hit": False}
+    started = time.perf_counter()
+    
+    try:
+        if tool.get("output_schema"):
+            # 構造化出力（JSON）として生成・検証
+            structured = await llm_service.generate_structured(
+                system_prompt=tool["system_prompt"],
+                user_prompt_template=tool["user_prompt_template"],
+                inputs=request.inputs,
+                output_schema=tool["output_schema"],
+                model=tool["llm_model"],
+                output_format=tool["output_format"],
+                usage=metadata,
+                warnings=warnings
+            )
+            output = json.dumps(structured, ensure_ascii=False, indent=2)
+        else:
+            output = await llm_service.generate(
+                system_prompt=tool["system_prompt"],
+                user_prompt_template=tool["user_prompt_template"],
+                inputs=request.inputs,
+                model=tool["llm_model"],
+                output_format=tool["output_format"],
+                usage=metadata
+            )
+    except StructuredOutputError as e:
+        await record_failure(tool, metadata, started)
+        raise HTTPException(status_code=502, detail=f"{e}: {' / '.join(e.errors)}")
+    except Exception as e:
+        await record_failure(tool, metadata, started)
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    metadata["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    
+    # 履歴を保存（保存の失敗は生成エラーとして集計しない）
     try:
-        output = await llm_service.generate(
-            system_prompt=tool["system_prompt"],
-            user_prompt_template=tool["user_prompt_template"],
-            inputs=request.inputs,
-            model=tool["llm_model"],
-            output_format=tool["output_format"]
-        )
-        
-        # 履歴を保存
         history_id = await save_history(
             tool_id=request.tool_id,
             tool_name=tool["name"],
             inputs=request.inputs,
-            output=output
+            output=output,
+            metadata=metadata
         )
-        
-        return {
-            "success": True,
-            "output": output,
-            "history_id": history_id
-        }
-    
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    
+    return {
+        "success": True,
+        "output": output,
+        "structured": structured,
+        "warnings": warnings,
+        "history_id": history_id
+    }
+
+
+async def record_failure(tool: dict, metadata: dict, started: float):
+    """生成失敗を利用集計に記録（記録の失敗で元のエラーを隠さない）"""
+    metadata["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    try:
+        await record_generation_error(tool["id"], tool["name"], metadata)
+    except Exception as e:
+        logger.warning("Failed to record generation error for tool %s: %s", tool["id"], e)
+
+
+# 分析API
+# 集計期間の上限（時間）
+ANALYTICS_MAX_HOURS = 24 * 366
+
+
+@app.get("/api/analytics")
+async def get_analytics(
+    hours: int = Query(24 * 7, ge=1, le=ANALYTICS_MAX_HOURS),
+    tool_id: Optional[str] = None
+):
+    """ツール別の実行回数・平均レイテンシ・トークン数・エラー率を取得"""
+    since_hour = (datetime.now() - timedelta(hours=hours - 1)).strftime("%Y-%m-%dT%H:00")
+    analytics = await get_usage_analytics(since_hour, tool_id=tool_id)
+    return {"hours": hours, **analytics}
 
 
 # 履歴API
@@ -225,6 +364,24 @@ async def list_history(limit: int = 50, search: Optional[str] = None):
     return {"history": history}
 
 
+@app.delete("/api/history")
+async def prune_history(before: str):
+    """指定日時（ISO形式）より古い履歴を削除"""
+    try:
+        cutoff = datetime.fromisoformat(before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="beforeはISO形式の日時で指定してください")
+    
+    # 履歴の日時はローカル時刻（タイムゾーンなし）で保存している
+    if cutoff.tzinfo is not None:
+        cutoff = cutoff.astimezone().replace(tzinfo=None)
+    if cutoff > datetime.now():
+        raise HTTPException(status_code=400, detail="beforeに未来の日時は指定できません")
+    
+    deleted = await delete_history_before(cutoff)
+    return {"success": True, "deleted": deleted}
+
+
 @app.delete("/api/history/{history_id}")
 async def delete_history_item(history_id: str):
     """履歴を削除"""
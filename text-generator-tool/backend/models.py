@@ -46,6 +46,7 @@ class ToolDefinitionBase(BaseModel):
     system_prompt: str
     user_prompt_template: str
     output_format: Optional[str] = None
+    output_schema: Optional[dict] = None  # JSONスキーマ（構造化出力用）
     input_fields: List[InputFieldDefinition]
 
 
@@ -73,6 +74,7 @@ class GenerationResult(BaseModel):
     tool_name: str
     inputs: dict
     output: str
+    structured: Optional[dict] = None  # 構造化出力のパース結果
     created_at: datetime
 
 
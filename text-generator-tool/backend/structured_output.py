@@ -0,0 +1,246 @@
+import json
+from typing import Any, List, Optional, Tuple
+
+
+class StructuredOutputError(ValueError):
+    """構造化出力の検証エラー"""
+
+    def __init__(self, message: str, errors: Optional[List[str]] = None):
+        super().__init__(message)
+        self.errors = errors or []
+
+
+_TYPE_CHECKS = {
+    "string": lambda v: isinstance(v, str),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+    "array": lambda v: isinstance(v, list),
+    "object": lambda v: isinstance(v, dict),
+}
+
+
+# Geminiのresponse_schemaとvalidate()の双方が扱えるキーワード
+SUPPORTED_SCHEMA_KEYWORDS = {"type", "enum", "required", "properties", "items", "description"}
+
+
+def check_schema(schema: Any) -> None:
+    """ツールに登録できるスキーマか確認（トップレベルはproperties付きのobject）"""
+    if not isinstance(schema, dict) or str(schema.get("type", "")).lower() != "object":
+        raise StructuredOutputError("出力スキーマのトップレベルはobject型である必要があります")
+    if not isinstance(schema.get("properties"), dict) or not schema["properties"]:
+        raise StructuredOutputError("出力スキーマにはpropertiesを1つ以上定義してください")
+    _check_sub_schema(schema, "$")
+
+
+def _check_sub_schema(schema: Any, path: str) -> None:
+    """スキーマを再帰的に確認し、未対応のキーワードや不正な定義を拒否"""
+    if not isinstance(schema, dict):
+        raise StructuredOutputError(f"{path}: スキーマはオブジェクトで定義してください")
+
+    unsupported = sorted(set(schema) - SUPPORTED_SCHEMA_KEYWORDS)
+    if unsupported:
+        raise StructuredOutputError(f"{path}: 未対応のキーワードです: {', '.join(unsupported)}")
+
+    if "type" in schema and str(schema["type"]).lower() not in _TYPE_CHECKS:
+        raise StructuredOutputError(f"{path}: 未対応の型です: {schema['type']}")
+    if "enum" in schema and not isinstance(schema["enum"], list):
+        raise StructuredOutputError(f"{path}.enum: 配列で指定してください")
+
+    properties = schema.get("properties", {})
+    if not isinstance(properties, dict):
+        raise StructuredOutputError(f"{path}.properties: オブジェクトで指定してください")
+    for key, sub_schema in properties.items():
+        _check_sub_schema(sub_schema, f"{path}.{key}")
+
+    required = schema.get("required", [])
+    if not isinstance(required, list) or any(key not in properties for key in required):
+        raise StructuredOutputError(f"{path}.required: propertiesに定義した項目名の配列で指定してください")
+
+    if "items" in schema:
+        _check_sub_schema(schema["items"], f"{path}[]")
+
+
+def validate(value: Any, schema: dict, path: str = "$") -> List[str]:
+    """JSONスキーマ（type/enum/required/properties/itemsのサブセット）で値を検証"""
+    errors = []
+    expected = schema.get("type")
+    if expected:
+        check = _TYPE_CHECKS.get(str(expected).lower())
+        if check and not check(value):
+            return [f"{path}: {expected}型である必要があります"]
+
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{path}: {schema['enum']} のいずれかである必要があります")
+
+    if isinstance(value, dict):
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{path}.{key}: 必須項目がありません")
+        for key, sub_schema in schema.get("properties", {}).items():
+            if key in value:
+                errors.extend(validate(value[key], sub_schema, f"{path}.{key}"))
+
+    if isinstance(value, list) and isinstance(schema.get("items"), dict):
+        for i, item in enumerate(value):
+            errors.extend(validate(item, schema["items"], f"{path}[{i}]"))
+
+    return errors
+
+
+class IncrementalObjectParser:
+    """ストリーミング中のJSONオブジェクトをトップレベルのプロパティ単位で逐次パース
+
+    値は後続の区切り文字（, または }）が届いた時点で確定するため、
+    数値やリテラルが途中で切れていても誤って確定しない。
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._state = "start"
+        self._key = None
+        self.fields = {}
+        self.finished = False
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """チャンクを追加し、新たに確定したプロパティを返す"""
+        self._buffer += chunk
+        completed = []
+
+        while not self.finished:
+            self._skip_whitespace()
+            if self._pos >= len(self._buffer):
+                break
+
+            char = self._buffer[self._pos]
+
+            if self._state == "start":
+                # コードフェンス等の前置きは読み飛ばす
+                start = self._buffer.find("{", self._pos)
+                if start < 0:
+                    self._pos = len(self._buffer)
+                    break
+                self._pos = start + 1
+                self._state = "key"
+
+            elif self._state == "key":
+                if char == "}":
+                    self._pos += 1
+                    self.finished = True
+                    break
+                try:
+                    self._key, self._pos = self._decoder.raw_decode(self._buffer, self._pos)
+                except json.JSONDecodeError:
+                    break
+                self._state = "colon"
+
+            elif self._state == "colon":
+                if char != ":":
+                    break
+                self._pos += 1
+                self._state = "value"
+
+            elif self._state == "value":
+                try:
+                    value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                except json.JSONDecodeError:
+                    break
+                # 区切り文字が続かない場合は数値の途中（12. や 1e など）の可能性があるため待つ
+                rest = self._buffer[end:].lstrip()
+                if not rest or rest[0] not in ",}":
+                    break
+                self._pos = end
+                self.fields[self._key] = value
+                completed.append((self._key, value))
+                self._state = "separator"
+
+            elif self._state == "separator":
+                if char == ",":
+                    self._pos += 1
+                    self._state = "key"
+                elif char == "}":
+                    self._pos += 1
+                    self.finished = True
+                else:
+                    break
+
+        return completed
+
+    def close(self) -> List[Tuple[str, Any]]:
+        """ストリーム終了時に、区切り文字のない最後の値を確定して返す"""
+        if self.finished or self._state != "value":
+            return []
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            return []
+        if self._buffer[end:].strip():
+            return []
+        self._pos = end
+        self.fields[self._key] = value
+        self._state = "separator"
+        return [(self._key, value)]
+
+    def _skip_whitespace(self):
+        while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\r\n":
+            self._pos += 1
+
+
+class StructuredOutputCollector:
+    """逐次パースしたプロパティをスキーマで検証し、再生成が必要な項目を管理"""
+
+    def __init__(self, schema: dict):
+        self.schema = schema
+        self.properties = schema.get("properties", {})
+        self.values = {}
+        self.errors = {}
+
+    def feed_stream(self, chunks) -> None:
+        """ストリームのチャンクを順に処理"""
+        parser = IncrementalObjectParser()
+        for chunk in chunks:
+            for key, value in parser.feed(chunk):
+                self.accept(key, value)
+        for key, value in parser.close():
+            self.accept(key, value)
+
+    def accept(self, key: str, value: Any) -> None:
+        """確定したプロパティを検証して取り込む"""
+        if key not in self.properties:
+            return
+        errors = validate(value, self.properties[key], f"$.{key}")
+        if errors:
+            self.errors[key] = errors
+        else:
+            self.values[key] = value
+            self.errors.pop(key, None)
+
+    def failing_keys(self) -> List[str]:
+        """検証に失敗した項目と未出力の必須項目"""
+        missing = [k for k in self.schema.get("required", []) if k not in self.values]
+        return list(dict.fromkeys(list(self.errors) + missing))
+
+    def drop_optional_errors(self) -> List[str]:
+        """不正なままの任意項目を除外し、そのエラーを返す"""
+        required = set(self.schema.get("required", []))
+        dropped = []
+        for key in [k for k in self.errors if k not in required]:
+            dropped.extend(self.errors.pop(key))
+        return dropped
+
+    def sub_schema(self, keys: List[str]) -> dict:
+        """指定した項目だけを対象にしたスキーマ"""
+        return {
+            "type": "object",
+            "properties": {k: self.properties[k] for k in keys if k in self.properties},
+            "required": [k for k in keys if k in self.properties],
+        }
+
+    def error_messages(self) -> List[str]:
+        messages = [m for errors in self.errors.values() for m in errors]
+        for key in self.schema.get("required", []):
+            if key not in self.values and key not in self.errors:
+                messages.append(f"$.{key}: 必須項目がありません")
+        return messages
@@ -0,0 +1,92 @@
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "test.db")
+    monkeypatch.setattr(database, "DATABASE_PATH", path)
+    asyncio.run(database.init_db())
+    return path
+
+
+def outputs(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return dict(conn.execute("SELECT content, ref_count FROM outputs").fetchall())
+
+
+def save(output):
+    return asyncio.run(database.save_history("tool", "ツール", {}, output))
+
+
+def test_identical_outputs_share_one_row(db_path):
+    save("A")
+    save("A")
+    save("B")
+    assert outputs(db_path) == {"A": 2, "B": 1}
+    assert sorted(h["output"] for h in asyncio.run(database.get_history())) == ["A", "A", "B"]
+
+
+def test_delete_history_releases_and_removes_orphans(db_path):
+    first = save("A")
+    second = save("A")
+
+    asyncio.run(database.delete_history(first))
+    assert outputs(db_path) == {"A": 1}
+
+    asyncio.run(database.delete_history(second))
+    assert outputs(db_path) == {}
+
+
+def test_overlapping_deletes_release_once(db_path):
+    target = save("A")
+    save("A")
+    save("B")
+
+    async def delete_twice():
+        await asyncio.gather(
+            database.delete_history(target),
+            database.delete_history(target),
+        )
+
+    asyncio.run(delete_twice())
+
+    assert outputs(db_path) == {"A": 1, "B": 1}
+    assert sorted(h["output"] for h in asyncio.run(database.get_history())) == ["A", "B"]
+
+
+def test_delete_missing_history_is_noop(db_path):
+    save("A")
+    asyncio.run(database.delete_history("missing"))
+    assert outputs(db_path) == {"A": 1}
+
+
+def test_delete_history_before_overlapping_single_delete(db_path):
+    target = save("A")
+    save("A")
+    save("B")
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("UPDATE history SET created_at = '2000-01-01' WHERE id = ?", (target,))
+
+    async def prune_and_delete():
+        return await asyncio.gather(
+            database.delete_history_before(datetime(2001, 1, 1)),
+            database.delete_history(target),
+        )
+
+    asyncio.run(prune_and_delete())
+
+    assert outputs(db_path) == {"A": 1, "B": 1}
+
+
+def test_delete_history_before_removes_orphans(db_path):
+    save("A")
+    save("B")
+    deleted = asyncio.run(database.delete_history_before(datetime.now() + timedelta(seconds=1)))
+    assert deleted == 2
+    assert outputs(db_path) == {}
@@ -0,0 +1,229 @@
+import asyncio
+
+import pytest
+
+from llm_service import LLMService
+from structured_output import (
+    IncrementalObjectParser,
+    StructuredOutputCollector,
+    StructuredOutputError,
+    check_schema,
+)
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "subject": {"type": "string"},
+        "hashtags": {"type": "array", "items": {"type": "string"}},
+        "count": {"type": "integer"},
+        "urgent": {"type": "boolean"},
+    },
+    "required": ["subject", "hashtags", "count"],
+}
+
+DOCUMENT = '{"subject": "件名", "hashtags": ["#a", "#b"], "count": 123, "urgent": true}'
+EXPECTED = {"subject": "件名", "hashtags": ["#a", "#b"], "count": 123, "urgent": True}
+
+
+def feed_all(parser, chunks):
+    completed = []
+    for chunk in chunks:
+        completed.extend(parser.feed(chunk))
+    return completed
+
+
+def test_parser_one_char_chunks():
+    parser = IncrementalObjectParser()
+    completed = feed_all(parser, list(DOCUMENT))
+    assert dict(completed) == EXPECTED
+    assert [key for key, _ in completed] == list(EXPECTED)
+    assert parser.finished
+
+
+@pytest.mark.parametrize("size", [2, 3, 7, 16, len(DOCUMENT)])
+def test_parser_arbitrary_chunks(size):
+    parser = IncrementalObjectParser()
+    chunks = [DOCUMENT[i:i + size] for i in range(0, len(DOCUMENT), size)]
+    assert dict(feed_all(parser, chunks)) == EXPECTED
+    assert parser.finished
+
+
+def test_parser_waits_for_number_cut_mid_value():
+    parser = IncrementalObjectParser()
+    assert parser.feed('{"count": 12') == []
+    assert parser.feed("3") == []
+    assert parser.feed("}") == [("count", 123)]
+
+
+@pytest.mark.parametrize("head, tail, expected", [
+    ("12.", "5}", 12.5),
+    ("1e", "3}", 1000.0),
+    ("1e-", "2}", 0.01),
+    ("-", "7}", -7),
+])
+def test_parser_waits_for_number_cut_at_boundary(head, tail, expected):
+    parser = IncrementalObjectParser()
+    assert parser.feed('{"title": "t", "price": ' + head) == [("title", "t")]
+    assert parser.feed(tail) == [("price", expected)]
+    assert parser.finished
+
+
+def test_collector_does_not_accept_truncated_exponent():
+    collector = StructuredOutputCollector({
+        "type": "object",
+        "properties": {"title": {"type": "string"}, "price": {"type": "number"}},
+        "required": ["title", "price"],
+    })
+    collector.feed_stream(['{"title": "t", "price": 1e', '3}'])
+    assert collector.values == {"title": "t", "price": 1000.0}
+    assert collector.failing_keys() == []
+
+
+def test_parser_close_ignores_number_cut_at_boundary():
+    parser = IncrementalObjectParser()
+    parser.feed('{"price": 12.')
+    assert parser.close() == []
+
+
+def test_parser_waits_for_literal_cut_mid_value():
+    parser = IncrementalObjectParser()
+    assert parser.feed('{"urgent": tr') == []
+    assert parser.feed("ue") == []
+    assert parser.feed(", ") == [("urgent", True)]
+    assert not parser.finished
+
+
+def test_parser_close_flushes_final_value_of_truncated_stream():
+    parser = IncrementalObjectParser()
+    assert parser.feed('{"subject": "a", "count": 12') == [("subject", "a")]
+    assert parser.close() == [("count", 12)]
+
+
+def test_parser_close_ignores_incomplete_final_value():
+    parser = IncrementalObjectParser()
+    parser.feed('{"subject": "a", "hashtags": ["#a", ')
+    assert parser.close() == []
+
+
+def test_parser_skips_code_fence_preamble():
+    parser = IncrementalObjectParser()
+    completed = feed_all(parser, ["```json\n", DOCUMENT[:10], DOCUMENT[10:], "\n```"])
+    assert dict(completed) == EXPECTED
+    assert parser.finished
+
+
+def test_malformed_value_stalls_and_is_marked_failing():
+    collector = StructuredOutputCollector(SCHEMA)
+    collector.feed_stream(['{"subject": "ok", "hashtags": [#a], "count": 1}'])
+    assert collector.values == {"subject": "ok"}
+    assert collector.failing_keys() == ["hashtags", "count"]
+
+
+def test_invalid_value_is_marked_failing():
+    collector = StructuredOutputCollector(SCHEMA)
+    collector.feed_stream(['{"subject": "ok", "hashtags": ["#a", 1], "count": 2}'])
+    assert collector.values == {"subject": "ok", "count": 2}
+    assert collector.failing_keys() == ["hashtags"]
+    assert collector.error_messages() == ["$.hashtags[1]: string型である必要があります"]
+
+
+class StubbedStreamService(LLMService):
+    """_stream_structuredを差し替え、呼び出しごとに用意したチャンクを流す"""
+
+    def __init__(self, responses):
+        super().__init__()
+        self.initialize("test-key")
+        self.responses = list(responses)
+        self.calls = []
+
+    async def _stream_structured(self, system_prompt, user_prompt, schema, model, collector, usage=None):
+        self.calls.append({"prompt": user_prompt, "schema": schema})
+        collector.feed_stream(self.responses.pop(0))
+
+
+def generate(service, warnings=None):
+    return asyncio.run(service.generate_structured(
+        system_prompt="system",
+        user_prompt_template="{{topic}}",
+        inputs={"topic": "テスト"},
+        output_schema=SCHEMA,
+        warnings=warnings,
+    ))
+
+
+def test_retry_requests_only_failing_keys_and_keeps_accepted_values():
+    service = StubbedStreamService([
+        ['{"subject": "件名", "hashtags": [1], ', '"count": '],
+        ['{"hashtags": ["#ok"], "count": 3}'],
+    ])
+
+    result = generate(service)
+
+    assert result == {"subject": "件名", "hashtags": ["#ok"], "count": 3}
+    assert len(service.calls) == 2
+    retry = service.calls[1]
+    assert set(retry["schema"]["properties"]) == {"hashtags", "count"}
+    assert retry["schema"]["required"] == ["hashtags", "count"]
+    assert '"subject": "件名"' in retry["prompt"]
+
+
+def test_retry_stops_once_all_fields_are_valid():
+    service = StubbedStreamService([[DOCUMENT]])
+    assert generate(service) == EXPECTED
+    assert len(service.calls) == 1
+
+
+def test_retry_gives_up_after_limit():
+    service = StubbedStreamService([
+        ['{"subject": 1}'],
+        ['{"subject": 2}'],
+        ['{"subject": 3}'],
+    ])
+    with pytest.raises(StructuredOutputError) as excinfo:
+        generate(service)
+    assert len(service.calls) == 3
+    assert "$.subject: string型である必要があります" in excinfo.value.errors
+
+
+@pytest.mark.parametrize("schema", [
+    {"type": "object", "properties": {"a": "string"}},
+    {"type": "object", "properties": {"a": {"type": "string", "minLength": 1}}},
+    {"type": "object", "additionalProperties": False, "properties": {"a": {"type": "string"}}},
+    {"type": "object", "properties": {"a": {"type": "array", "items": "string"}}},
+    {"type": "object", "properties": {"a": {"type": "string"}}, "required": ["b"]},
+    {"type": "array", "items": {"type": "string"}},
+])
+def test_check_schema_rejects_unsupported_schemas(schema):
+    with pytest.raises(StructuredOutputError):
+        check_schema(schema)
+
+
+def test_check_schema_accepts_supported_subset():
+    check_schema(SCHEMA)
+
+
+def test_invalid_optional_field_is_dropped_after_retries():
+    service = StubbedStreamService([
+        ['{"subject": "件名", "hashtags": [], "count": 1, "urgent": "yes"}'],
+        ['{"urgent": "yes"}'],
+        ['{"urgent": "no"}'],
+    ])
+    warnings = []
+
+    result = generate(service, warnings)
+
+    assert result == {"subject": "件名", "hashtags": [], "count": 1}
+    assert len(service.calls) == 3
+    assert set(service.calls[1]["schema"]["properties"]) == {"urgent"}
+    assert warnings == ["$.urgent: boolean型である必要があります"]
+
+
+def test_invalid_required_field_still_fails_when_optional_is_dropped():
+    service = StubbedStreamService([
+        ['{"subject": 1, "hashtags": [], "count": 1, "urgent": "yes"}'],
+        ['{"subject": 2, "urgent": "yes"}'],
+        ['{"subject": 3, "urgent": "yes"}'],
+    ])
+    with pytest.raises(StructuredOutputError) as excinfo:
+        generate(service)
+    assert excinfo.value.errors == ["$.subject: string型である必要があります"]
@@ -38,6 +38,7 @@ export default function ToolEditorPage() {
     system_prompt: '',
     user_prompt_template: '',
     output_format: '',
+    output_schema: '',
     input_fields: []
   })
 
@@ -61,6 +62,7 @@ export default function ToolEditorPage() {
         system_prompt: tool.system_prompt,
         user_prompt_template: tool.user_prompt_template,
         output_format: tool.output_format || '',
+        output_schema: tool.output_schema ? JSON.stringify(tool.output_schema, null, 2) : '',
         input_fields: tool.input_fields
       })
     }
@@ -111,6 +113,13 @@ export default function ToolEditorPage() {
     if (!formData.description.trim()) newErrors.description = '説明は必須です'
     if (!formData.system_prompt.trim()) newErrors.system_prompt = 'システムプロンプトは必須です'
     if (!formData.user_prompt_template.trim()) newErrors.user_prompt_template = 'ユーザープロンプトは必須です'
+    if (formData.output_schema.trim()) {
+      try {
+        JSON.parse(formData.output_schema)
+      } catch {
+        newErrors.output_schema = 'JSONスキーマの形式が正しくありません'
+      }
+    }
     
     formData.input_fields.forEach((field, index) => {
       if (!field.name.trim()) {
@@ -129,9 +138,14 @@ export default function ToolEditorPage() {
     e.preventDefault()
     if (!validate()) return
 
+    const toolData = {
+      ...formData,
+      output_schema: formData.output_schema.trim() ? JSON.parse(formData.output_schema) : null
+    }
+
     const result = isEditMode 
-      ? await updateTool(id, formData)
-      : await createTool(formData)
+      ? await updateTool(id, toolData)
+      : await createTool(toolData)
 
     if (result.success) {
       navigate('/tools')
@@ -463,6 +477,25 @@ export default function ToolEditorPage() {
                 className="w-full px-4 py-3 bg-surface-800 border border-surface-700 rounded-xl text-surface-100 placeholder-surface-500 focus:border-primary-500/50 transition-colors"
               />
             </div>
+
+            <div>
+              <label className="block text-sm font-medium text-surface-300 mb-2">
+                出力スキーマ（JSON Schema・オプション）
+              </label>
+              <p className="text-xs text-surface-500 mb-2">
+                指定すると構造化出力（JSON）として生成し、スキーマに合わない項目のみ再生成します
+              </p>
+              <textarea
+                value={formData.output_schema}
+                onChange={(e) => handleChange('output_schema', e.target.value)}
+                placeholder={`例:\n{\n  "type": "object",\n  "properties": {\n    "subject": { "type": "string" },\n    "body": { "type": "string" }\n  },\n  "required": ["subject", "body"]\n}`}
+                rows={6}
+                className={`w-full px-4 py-3 bg-surface-800 border rounded-xl text-surface-100 placeholder-surface-500 font-mono text-sm resize-none transition-colors ${
+                  errors.output_schema ? 'border-red-500' : 'border-surface-700 focus:border-primary-500/50'
+                }`}
+              />
+              {errors.output_schema && <p className="text-red-400 text-sm mt-1">{errors.output_schema}</p>}
+            </div>
           </div>
         </section>
 
@@ -5,6 +5,7 @@ const API_BASE = import.meta.env.VITE_API_URL || '/api'
 export const useStore = create((set, get) => ({
   // 状態
   tools: [],
+  toolsEtag: null,
   currentTool: null,
   history: [],
   isLoading: false,
@@ -17,9 +18,18 @@ export const useStore = create((set, get) => ({
   fetchTools: async () => {
     set({ isLoading: true, error: null })
     try {
-      const res = await fetch(`${API_BASE}/tools`)
+      // 一覧用の軽量データを取得し、変更がなければ304で再利用
+      const { toolsEtag } = get()
+      const res = await fetch(`${API_BASE}/tools?view=summary`, {
+        headers: toolsEtag ? { 'If-None-Match': toolsEtag } : {},
+        cache: 'no-store'
+      })
+      if (res.status === 304) {
+        set({ isLoading: false })
+        return
+      }
       const data = await res.json()
-      set({ tools: data.tools, isLoading: false })
+      set({ tools: data.tools, toolsEtag: res.headers.get('ETag'), isLoading: false })
     } catch (err) {
       set({ error: err.message, isLoading: false })
     }